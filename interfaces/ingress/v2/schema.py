@@ -23,11 +23,16 @@ Examples:
               "model": "model-name"
               }
 """
+import json
+
 import yaml
 from pydantic import BaseModel, AnyHttpUrl, validator, Field
 
 from interface_tester.schema_base import DataBagSchema
 
+# use the libyaml-backed loader when PyYAML was built with it
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 class Url(BaseModel):
     url: AnyHttpUrl
@@ -38,7 +43,11 @@ class MyProviderData(BaseModel):
 
     @validator('ingress', pre=True)
     def decode_ingress(cls, ingress):
-        return yaml.safe_load(ingress)
+        # JSON is valid YAML and much cheaper to parse: try it first
+        try:
+            return json.loads(ingress)
+        except ValueError:
+            return yaml.load(ingress, Loader=_YAML_LOADER)
 
 
 class ProviderSchema(DataBagSchema):
@@ -51,6 +60,12 @@ class IngressRequirerAppData(BaseModel):
     port: str = Field(description="The port the unit wishes to be exposed. Stringified int.")
     name: str = Field(description="The name of the application requesting ingress.")
 
+    @validator('port')
+    def validate_port(cls, port):
+        if not 1 <= int(port) <= 65535:
+            raise ValueError(f"port {port} out of range")
+        return port
+
 
 class IngressRequirerUnitData(BaseModel):
     host: str = Field(description="Unit hostname to be exposed.")
@@ -2,14 +2,31 @@
 # Copyright 2023 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import functools
+import hashlib
+import importlib.metadata
 import json
 import logging
 import os
+import shlex
 import shutil
 import subprocess
+import sys
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import TYPE_CHECKING, Dict, Iterable, Literal, Tuple
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    Literal,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
 from interface_tester.collector import collect_tests
 
@@ -27,8 +44,65 @@ if TYPE_CHECKING:
     # mapping from interface names (e.g. 'ingress') to results per version
     _ResultsPerInterface = Dict[str, _ResultsPerVersion]
 
-# it is "python -m venv" on some platforms/python versions
-MKVENV_CMD = os.getenv("MKVENV_CMD", "python -m virtualenv")
+
+def _pip_has_python_option() -> bool:
+    """Whether the pip running this script can install into other environments."""
+    try:
+        major, minor = importlib.metadata.version("pip").split(".")[:2]
+        # `pip --python` was added in pip 22.3
+        return (int(major), int(minor)) >= (22, 3)
+    except (importlib.metadata.PackageNotFoundError, ValueError):
+        return False
+
+
+# when possible, the charm venvs get no pip of their own: packages are installed in them
+# by the pip running this script, which skips bootstrapping pip in every venv
+OUTER_PIP = _pip_has_python_option()
+# used to create the charm venvs when uv is not available
+MKVENV_CMD = shlex.split(
+    os.getenv("MKVENV_CMD", f"python -m venv{' --without-pip' if OUTER_PIP else ''}")
+)
+
+# packages installed in each charm venv on top of the charm's own requirements. They are
+# part of the venv fingerprint, so pinning the tester (keep it in sync with pyproject.toml)
+# makes cached venvs get rebuilt when it is bumped
+VENV_PACKAGES = ["setuptools", "pytest", "pytest-interface-tester==0.1.1"]
+# file in each charm venv recording the packages and requirements it was built from
+VENV_STAMP = "interface-venv.sha256"
+# pip cache shared by all charm venvs, so that wheels are only downloaded/built once
+PIP_CACHE_DIR = Path.home() / ".cache" / "charm-interface-pip"
+
+# free space required to put the test root in /dev/shm
+MIN_SHM_FREE_BYTES = 8 * 1024**3
+SHM_TEST_ROOT = Path("/dev/shm/charm-relation-interfaces-tests")
+TMP_TEST_ROOT = Path("/tmp/charm-relation-interfaces-tests/")
+
+
+def _default_test_root() -> Path:
+    """Get the directory to clone the charms and set up their venvs in.
+
+    Prefer the RAM-backed /dev/shm, to keep the small-file IO of git and pip off the disk.
+    It is only picked for a new root if it has enough room; once there, the root keeps
+    being used so that the cache of previous runs isn't lost as it fills /dev/shm up.
+    Can be overridden with the CHARM_TEST_ROOT envvar.
+    """
+    if root := os.getenv("CHARM_TEST_ROOT"):
+        return Path(root)
+    if SHM_TEST_ROOT.is_dir():
+        return SHM_TEST_ROOT
+    shm = SHM_TEST_ROOT.parent
+    if shm.is_dir() and shutil.disk_usage(shm).free >= MIN_SHM_FREE_BYTES:
+        return SHM_TEST_ROOT
+    return TMP_TEST_ROOT
+
+
+TEST_ROOT = _default_test_root()
+
+# how many charm repositories to clone concurrently
+CLONE_JOBS = 16
+
+# how much of the output of failed pytest runs to log
+PYTEST_LOG_TAIL_BYTES = 4000
 
 FIXTURE_PATH = "tests/interface/conftest.py"
 FIXTURE_IDENTIFIER = "interface_tester"
@@ -36,6 +110,9 @@ logging.getLogger().setLevel(logging.INFO)
 
 FixtureSpec = namedtuple("FixtureSpec", "path id")
 
+# mapping from charm name to the lock guarding its local checkout
+_CHARM_LOCKS: Dict[str, threading.Lock] = {}
+
 
 class SetupError(Exception):
     pass
@@ -45,37 +122,102 @@ class InterfaceTestError(Exception):
     pass
 
 
-def _clone_charm_repo(charm_config: "_CharmTestConfig", charm_path: Path):
+def _clone_charm_repo(name: str, url: str, branch: Optional[str], charm_path: Path):
     """Clones a charm repository to a local path."""
-    logging.info(
-        f"Cloning: {charm_config.name} from ({charm_config.url}@{charm_config.branch or 'main'})"
-    )
-    branch_option = ""
-    if charm_config.branch:
-        branch_option = f"--branch {charm_config.branch}"
+    logging.info(f"Cloning: {name} from ({url}@{branch or 'main'})")
+    branch_option = []
+    if branch:
+        branch_option = ["--branch", branch]
         logging.warning(
-            f"custom branch provided for {charm_config.name}; "
-            f"this should only be done in staging"
+            f"custom branch provided for {name}; this should only be done in staging"
         )
-    subprocess.call(
-        f"git clone --quiet --depth 1 {branch_option} {charm_config.url} {charm_path}",
-        shell=True,
-        stdout=subprocess.DEVNULL,
-    )
+    clone_cmd = ["git", "clone", "--quiet", "--depth", "1", "--single-branch"]
+    try:
+        subprocess.run(
+            [*clone_cmd, *branch_option, url, str(charm_path)],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    except subprocess.CalledProcessError as e:
+        # a failed checkout can leave a partial clone behind, which would be mistaken
+        # for a usable one and block any later attempt to clone
+        shutil.rmtree(charm_path, ignore_errors=True)
+        raise SetupError(f"unable to clone {name} from {url}") from e
+
+
+def _refresh_charm_repo(name: str, branch: Optional[str], charm_path: Path):
+    """Update an existing charm clone to the tip of its branch."""
+    logging.info(f"Refreshing: {name} ({branch or 'HEAD'})")
+    git = ["git", "-C", str(charm_path)]
+    try:
+        subprocess.run(
+            [*git, "fetch", "--quiet", "--depth", "1", "origin", branch or "HEAD"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        subprocess.run(
+            [*git, "reset", "--quiet", "--hard", "FETCH_HEAD"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    except subprocess.CalledProcessError:
+        logging.warning(f"unable to refresh {name}; testing the local copy as is")
+    # if requirements.txt changed, the venv stamp no longer matches: _setup_venv will
+    # rebuild the venv before the charm is tested
+
+
+def _ensure_cloned(
+    charm_config: "_CharmTestConfig",
+    root: Path = TEST_ROOT,
+) -> None:
+    """Clone a charm repository, or refresh the local copy if it already exists.
+
+    Set the CHARM_TEST_NO_REFRESH envvar to test existing local copies as they are.
+    """
+    charm_path = root / Path(charm_config.name)
+    if charm_path.exists():
+        if not os.getenv("CHARM_TEST_NO_REFRESH"):
+            _refresh_charm_repo(charm_config.name, charm_config.branch, charm_path)
+        return
+    try:
+        _clone_charm_repo(
+            charm_config.name, charm_config.url, charm_config.branch, charm_path
+        )
+    except SetupError:
+        # the clone will be retried, and the failure reported, when the charm is tested
+        logging.warning(f"pre-cloning {charm_config.name} failed", exc_info=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _prepare_charm_once(name: str, url: str, branch: Optional[str], root: Path) -> Path:
+    """Clone the charm repository unless it is already there, and return its path.
+
+    The result is memoized, so a charm is only cloned once per run even if it is tested
+    against several interfaces, versions or roles.
+    """
+    charm_path = root / Path(name)
+    if not charm_path.exists():
+        _clone_charm_repo(name, url, branch, charm_path)
+    return charm_path
 
 
 def _prepare_repo(
     charm_config: "_CharmTestConfig",
     interface: str,
     version: int,
-    root: Path = Path("/tmp/charm-relation-interfaces-tests/"),
-) -> Tuple[Path, Path]:
-    """Clone the charm repository and create the venv if it hasn't been done already."""
+    root: Path = TEST_ROOT,
+) -> Tuple[Path, Path, Path]:
+    """Clone the charm repository and create the venv if it hasn't been done already.
+
+    Return the path to the charm, to the python of its venv and to the generated test.
+    """
     logging.info(f"Preparing testing environment for: {charm_config.name}")
-    charm_path = root / Path(charm_config.name)
-    if not charm_path.exists():
-        _clone_charm_repo(charm_config, charm_path)
-        _setup_venv(charm_path)
+    charm_path = _prepare_charm_once(
+        charm_config.name, charm_config.url, charm_config.branch, root
+    )
+    # not memoized: the checkout may have been refreshed to new requirements since the
+    # venv was last checked, in which case it gets rebuilt
+    venv_python = _setup_venv(charm_path)
     try:
         fixture_spec = _get_fixture(charm_config, charm_path)
     except FileNotFoundError as e:
@@ -87,13 +229,17 @@ def _prepare_repo(
     test_path = _generate_test(
         interface, fixture_spec.path.parent, fixture_spec.id, version
     )
-    return charm_path, test_path
+    return charm_path, venv_python, test_path
+
 
+def _clean(roots: Iterable[Path] = (TEST_ROOT, SHM_TEST_ROOT, TMP_TEST_ROOT)):
+    """Clean the directories used to store repos for the tests.
 
-def _clean(root: Path = Path("/tmp/charm-relation-interfaces-tests/")):
-    """Clean the directory used to store repos for the tests."""
-    if root.is_dir():
-        shutil.rmtree(root)
+    All the default locations are cleaned, as previous runs may have used another one.
+    """
+    for root in roots:
+        if root.is_dir():
+            shutil.rmtree(root)
 
 
 _TEST_CONTENT = """
@@ -108,18 +254,26 @@ def test_{interface}_interface({fixture_id}: InterfaceTester):
 """
 
 
+@functools.lru_cache(maxsize=None)
+def _render_test(interface: str, fixture_id: str, version: int) -> bytes:
+    """Render the content of a pytest file for an interface."""
+    return _TEST_CONTENT.format(
+        interface=interface, fixture_id=fixture_id, version=version
+    ).encode()
+
+
 def _generate_test(
     interface: str, test_path: Path, fixture_id: str, version: int
 ) -> Path:
     """Generate a pytest file for a given charm and interface."""
     logging.info(f"Generating test file for {interface} at {test_path}")
-    test_content = _TEST_CONTENT.format(
-        interface=interface, fixture_id=fixture_id, version=version
-    )
-    test_filename = f"interface-test-{interface}.py"
-    with open(test_path / test_filename, "w") as file:
-        file.write(test_content)
-    return test_path / test_filename
+    test_content = _render_test(interface, fixture_id, version)
+    # one file per version, so that tests for different versions can run concurrently
+    test_file = test_path / f"interface-test-{interface}-v{version}.py"
+    # leave an up-to-date file untouched, e.g. when testing another role of the charm
+    if not test_file.exists() or test_file.read_bytes() != test_content:
+        test_file.write_bytes(test_content)
+    return test_file
 
 
 def _get_fixture(charm_config: "_CharmTestConfig", charm_path: Path) -> FixtureSpec:
@@ -134,58 +288,113 @@ def _get_fixture(charm_config: "_CharmTestConfig", charm_path: Path) -> FixtureS
     return FixtureSpec(fixture_path, fixture_id)
 
 
-def _setup_venv(charm_path: Path) -> None:
-    """Create the venv for a charm and return the path to its python."""
+def _venv_fingerprint(charm_path: Path) -> str:
+    """Hash what goes into a charm venv: our own packages and the charm's requirements."""
+    digest = hashlib.sha256("\n".join(VENV_PACKAGES).encode())
+    requirements = charm_path / "requirements.txt"
+    if requirements.is_file():
+        digest.update(requirements.read_bytes())
+    return digest.hexdigest()
+
+
+def _setup_venv(charm_path: Path) -> Path:
+    """Create the venv for a charm and return the path to its python.
+
+    An existing venv is reused, unless it was built from different packages or requirements.
+    """
+    venv_path = charm_path.absolute() / ".interface-venv"
+    venv_python = venv_path / "bin" / "python"
+    stamp = venv_path / VENV_STAMP
+    fingerprint = _venv_fingerprint(charm_path)
+    if venv_python.exists() and stamp.is_file() and stamp.read_text() == fingerprint:
+        return venv_python
+    if venv_path.exists():
+        logging.info(f"Discarding outdated venv for {charm_path}")
+        shutil.rmtree(venv_path)
     logging.info(f"Preparing venv for {charm_path}")
 
-    original_wd = os.getcwd()
-    os.chdir(charm_path)
+    if shutil.which("uv"):
+        mkvenv_cmd = ["uv", "venv", "--quiet"]
+        install_cmd = ["uv", "pip", "install", "--python", str(venv_python)]
+        # uv already shares a single cache between all environments
+        install_env = dict(os.environ)
+    else:
+        mkvenv_cmd = MKVENV_CMD
+        install_env = {**os.environ, "PIP_CACHE_DIR": str(PIP_CACHE_DIR)}
+        if OUTER_PIP:
+            install_cmd = [sys.executable, "-m", "pip", "--python", str(venv_python)]
+        else:
+            install_cmd = [str(venv_python), "-m", "pip"]
+        install_cmd.append("install")
+
     # Create the venv and install the requirements
     try:
         subprocess.check_call(
-            f"{MKVENV_CMD} ./.interface-venv", shell=True, stdout=subprocess.DEVNULL
+            [*mkvenv_cmd, str(venv_path)],
+            cwd=charm_path,
+            stdout=subprocess.DEVNULL,
         )
         logging.info(f"Installing dependencies in venv for {charm_path}")
 
+        # a single install, so the dependencies are resolved in one go
         subprocess.check_call(
-            ".interface-venv/bin/python -m pip install setuptools pytest pytest-interface-tester",
-            shell=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        subprocess.check_call(
-            ".interface-venv/bin/python -m pip install -r requirements.txt",
-            shell=True,
+            [*install_cmd, *VENV_PACKAGES, "-r", "requirements.txt"],
+            cwd=charm_path,
+            env=install_env,
             stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
         )
     except subprocess.CalledProcessError as e:
+        # don't leave a half-baked venv behind for the next run to pick up
+        shutil.rmtree(venv_path, ignore_errors=True)
         raise SetupError("venv setup failed") from e
-    os.chdir(original_wd)
+    stamp.write_text(fingerprint)
+    return venv_python
 
 
-def _run_test_with_pytest(root: Path, test_path: Path):
-    """Run a test file with pytest."""
+def _run_test_with_pytest(
+    root: Path, venv_python: Path, test_path: Path, log_path: Path
+):
+    """Run a test file with pytest.
+
+    The pytest output is written to `log_path`; only its tail is logged, if the tests fail.
+    """
     logging.info(f"Running tests for {root}")
-    original_wd = os.getcwd()
-    os.chdir(root)
-    try:
-        subprocess.check_call(
-            f"PYTHONPATH=src:lib .interface-venv/bin/python -m pytest {test_path}",
-            shell=True,
+    with open(log_path, "wb") as log:
+        returncode = subprocess.call(
+            [str(venv_python), "-m", "pytest", str(test_path)],
+            cwd=root,
+            env={**os.environ, "PYTHONPATH": "src:lib"},
+            stdout=log,
+            stderr=subprocess.STDOUT,
         )
-    except subprocess.CalledProcessError as e:
-        raise InterfaceTestError from e
-    os.chdir(original_wd)
+    if returncode:
+        output = log_path.read_bytes()[-PYTEST_LOG_TAIL_BYTES:]
+        logging.warning(f"pytest output for {root}:\n{output.decode(errors='replace')}")
+        raise InterfaceTestError(
+            f"pytest exited with {returncode}; full output in {log_path}"
+        )
+
+
+def _get_charm_lock(charm_name: str) -> threading.Lock:
+    """Get the lock guarding the local checkout of a charm."""
+    return _CHARM_LOCKS.setdefault(charm_name, threading.Lock())
 
 
 def _test_charm(
-    charm_config: "_CharmTestConfig", interface: str, version: int, role: str
+    charm_config: "_CharmTestConfig",
+    interface: str,
+    version: int,
+    role: str,
 ) -> bool:
     """Run interface tests for a charm."""
     logging.info(f"Running tests for charm: {charm_config.name}")
     try:
-        charm_path, test_path = _prepare_repo(charm_config, interface, version)
+        # the same charm can be tested for several interfaces at once: only let one
+        # thread at a time clone it, set up its venv and generate its test files
+        with _get_charm_lock(charm_config.name):
+            charm_path, venv_python, test_path = _prepare_repo(
+                charm_config, interface, version
+            )
     except SetupError:
         logging.warning(
             f"test setup failed for {charm_config.name} {interface} {role}",
@@ -194,7 +403,9 @@ def _test_charm(
         return False
 
     try:
-        _run_test_with_pytest(charm_path, test_path)
+        # roles may run the same test file concurrently: give each its own log
+        log_path = test_path.with_suffix(f".{role}.log")
+        _run_test_with_pytest(charm_path, venv_python, test_path, log_path)
     except InterfaceTestError:
         logging.warning(
             f"interface tests for {charm_config.name} {interface} {role} failed",
@@ -204,75 +415,101 @@ def _test_charm(
     return True
 
 
-def _test_charms(
-    charm_configs: Iterable["_CharmTestConfig"], interface: str, version: int, role: str
-) -> "_ResultsPerCharm":
-    """Test all charms against this interface and role."""
-    logging.info(f"Running tests for {interface}")
-    out = {}
-    for charm_config in charm_configs:
-        success = _test_charm(charm_config, interface, version, role)
-        out[charm_config.name] = success
-        logging.info(f"Result: {'PASSED' if success else 'FAILED'}")
-    return out
-
-
-def _test_roles(
-    tests_per_role: Dict["_Role", "_RoleTestSpec"], interface: str, version: int
-) -> "_ResultsPerRole":
-    """Run the tests for each role of this interface."""
-    results_per_role: _ResultsPerRole = {}
-    role: "_Role"
-    for role in ["provider", "requirer"]:
-        logging.info(f"Running tests for role: {role}")
-        interface_tests = tests_per_role[role]["tests"]
-        charm_configs = tests_per_role[role]["charms"]
-
-        if not interface_tests:
-            logging.info(f"No tests specified for {interface}/{role}; skipping...")
-            results_per_role[role] = {}
-        elif not charm_configs:
-            logging.info(f"No charms registered for {interface}/{role}; skipping...")
-            results_per_role[role] = {}
-        else:
-            logging.info(
-                f"Running {len(interface_tests)} {interface} interface tests on: "
-                f"{[charm.name for charm in charm_configs]}..."
-            )
-            results_per_role[role] = _test_charms(
-                charm_configs, interface, version, role
-            )
-    return results_per_role
-
-
-def _test_interface_version(tests_per_version, interface: str) -> "_ResultsPerVersion":
-    """Run the tests for each version of this interface."""
-    logging.info(f"Running tests for interface: {interface}")
-    results_per_version: _ResultsPerVersion = {}
-
-    for version, tests_per_role in tests_per_version.items():
-        logging.info(f"Running tests for version: {version}")
-
-        version_int = int(version[1:])
-        results_per_version[version] = _test_roles(
-            tests_per_role, interface, version_int
-        )
-
-    return results_per_version
-
-
-def run_interface_tests(path: Path, include: str = "*") -> "_ResultsPerInterface":
-    """Run the tests for the specified interfaces, defaulting to all."""
-    _clean()
-    test_results = {}
-    collected = collect_tests(path=path, include=include)
-    for interface, version_to_roles in collected.items():
-        results_per_version = _test_interface_version(version_to_roles, interface)
-        test_results[interface] = results_per_version
+def _enumerate_jobs(
+    collected: "Mapping[str, Dict[str, Dict[_Role, _RoleTestSpec]]]",
+) -> Iterator[Tuple[str, str, "_Role", "_CharmTestConfig"]]:
+    """Yield an (interface, version, role, charm config) tuple for each charm to test.
 
+    Roles that have no tests or no registered charms are skipped.
+    """
+    role: "_Role"
+    for interface, tests_per_version in collected.items():
+        for version, tests_per_role in tests_per_version.items():
+            for role in ["provider", "requirer"]:
+                interface_tests = tests_per_role[role]["tests"]
+                charm_configs = tests_per_role[role]["charms"]
+
+                if not interface_tests:
+                    logging.info(
+                        f"No tests specified for {interface}/{version}/{role}; skipping..."
+                    )
+                elif not charm_configs:
+                    logging.info(
+                        f"No charms registered for {interface}/{version}/{role}; skipping..."
+                    )
+                else:
+                    logging.info(
+                        f"Queueing {len(interface_tests)} {interface} {version} {role} "
+                        f"interface tests on: {[charm.name for charm in charm_configs]}..."
+                    )
+                    for charm_config in charm_configs:
+                        yield interface, version, role, charm_config
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_collect(
+    path: str, include: str
+) -> "Mapping[str, Dict[str, Dict[_Role, _RoleTestSpec]]]":
+    """Collect the interface tests, reusing the result of earlier calls in this process."""
+    # read-only, as the same object is handed out to every caller
+    return MappingProxyType(collect_tests(path=Path(path), include=include))
+
+
+def run_interface_tests(
+    path: Path, include: str = "*", jobs: Optional[int] = None, clean: bool = False
+) -> "_ResultsPerInterface":
+    """Run the tests for the specified interfaces, defaulting to all.
+
+    Every (interface, version, role, charm) combination is submitted to a single pool
+    running up to `jobs` tests concurrently; defaults to the number of CPUs.
+    Charm repositories and venvs from previous runs are reused unless `clean` is set.
+    """
+    if clean:
+        _clean()
+    jobs = jobs or os.cpu_count() or 1
+
+    collected = _cached_collect(str(path), include)
     if not collected:
         logging.warning("No tests collected.")
 
+    test_results: _ResultsPerInterface = {
+        interface: {
+            version: {"provider": {}, "requirer": {}} for version in tests_per_version
+        }
+        for interface, tests_per_version in collected.items()
+    }
+    test_jobs = list(_enumerate_jobs(collected))
+
+    # cloning is network-bound: fetch all the repositories up front with a wider pool
+    charm_configs = {charm.name: charm for *_, charm in test_jobs}
+    with ThreadPoolExecutor(max_workers=CLONE_JOBS) as executor:
+        list(executor.map(_ensure_cloned, charm_configs.values()))
+
+    # tests complete in any order: lay the charms out in charms.yaml order beforehand, so
+    # that the report is stable across runs
+    for interface, version, role, charm_config in test_jobs:
+        test_results[interface][version][role][charm_config.name] = False
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                _test_charm,
+                charm_config,
+                interface,
+                int(version[1:]),
+                role,
+            ): (interface, version, role, charm_config.name)
+            for interface, version, role, charm_config in test_jobs
+        }
+        for future in as_completed(futures):
+            interface, version, role, charm_name = futures[future]
+            success = future.result()
+            test_results[interface][version][role][charm_name] = success
+            logging.info(
+                f"Result for {charm_name} {interface} {version} {role}: "
+                f"{'PASSED' if success else 'FAILED'}"
+            )
+
     return test_results
 
 
@@ -291,6 +528,20 @@ if __name__ == "__main__":
         default="*",
         help="Glob to filter what interfaces to include in the test matrix.",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of charms to test concurrently.",
+    )
+    parser.add_argument(
+        "--clean",
+        action="store_true",
+        help="Remove the charm repositories and venvs cached by previous runs first.",
+    )
     args = parser.parse_args()
 
-    pprint_interface_test_results(run_interface_tests(Path("."), args.include))
+    pprint_interface_test_results(
+        run_interface_tests(Path("."), args.include, args.jobs, args.clean)
+    )